@@ -0,0 +1,129 @@
+import gzip
+import json
+import os
+import sys
+from collections import Counter
+from datetime import datetime, UTC
+
+from flask import current_app
+
+from server import create_app, db, Poll, Vote, PollArchive, ArchivedVoteCount, ArchivedVoter
+
+# Archives the votes of closed polls so that the vote table only holds votes of open polls.
+# Usage:
+#   python archive.py              archive every closed poll that hasn't been archived before
+#   python archive.py restore 12   move the votes of poll 12 back into the vote table
+#   python archive.py archive 12   archive poll 12 again after it has been restored
+
+def archive_path(file_name):
+    return os.path.join(current_app.config['ARCHIVE_DIR'], file_name)
+
+# Returns how many votes were archived, or None if the poll is already archived
+def archive_poll(poll):
+    archive = db.session.get(PollArchive, poll.poll_id)
+    if archive and not archive.restored:
+        return None
+
+    votes = Vote.query.filter_by(poll_id=poll.poll_id).order_by(Vote.vote_id).all()
+
+    # Stored column by column (one list per field) since that compresses a lot better than one object per vote.
+    # vote_id isn't kept, sqlite hands out deleted ids again so the old ones can't be reused on restore
+    columns = {
+        'option_id': [vote.option_id for vote in votes],
+        'user_id': [vote.user_id for vote in votes],
+    }
+
+    # Every archive gets a new file, so an older one is never overwritten before the db has been updated.
+    # The file is written completely before any row is deleted so a crash can't lose votes
+    archived_at = datetime.now(UTC)
+    file_name = f'poll_{poll.poll_id}_{archived_at:%Y%m%d%H%M%S%f}.json.gz'
+    path = archive_path(file_name)
+    os.makedirs(current_app.config['ARCHIVE_DIR'], exist_ok=True)
+    with gzip.open(path + '.tmp', 'wt', encoding='utf-8') as f:
+        json.dump({'poll_id': poll.poll_id, 'columns': columns}, f)
+    os.replace(path + '.tmp', path)
+
+    try:
+        counts = Counter(columns['option_id'])
+        for option in poll.options:
+            db.session.add(ArchivedVoteCount(option_id=option.option_id, poll_id=poll.poll_id,
+                                              votes=counts[option.option_id]))
+        for user_id in columns['user_id']:
+            db.session.add(ArchivedVoter(poll_id=poll.poll_id, user_id=user_id))
+        archive = archive or PollArchive(poll_id=poll.poll_id)
+        archive.file_name = file_name
+        archive.archived_at = archived_at
+        archive.restored = False
+        db.session.add(archive)
+
+        # Only the votes that were read (and written to the file), a vote that came in since then stays live.
+        # New rows always get an id above the current largest one, so the last id read marks where they start
+        if votes:
+            (Vote.query
+             .filter(Vote.poll_id == poll.poll_id, Vote.vote_id <= votes[-1].vote_id)
+             .delete(synchronize_session=False))
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        os.remove(path)
+        raise
+
+    db.session.expire(poll)
+    return len(votes)
+
+def archive_closed_polls(now=None):
+    now = now or datetime.now()
+    closed = (Poll.query
+              .outerjoin(PollArchive, PollArchive.poll_id == Poll.poll_id)
+              .filter(Poll.timeleft < now, PollArchive.poll_id.is_(None))
+              .all())
+    return {poll.poll_id: archive_poll(poll) for poll in closed}
+
+# Puts the archived votes back into the vote table, returns False if the poll wasn't archived.
+# Raises FileNotFoundError (and changes nothing) if the archive file is gone.
+# The poll is marked as restored so archive_closed_polls leaves it alone, use archive_poll to archive it again
+def restore_poll(poll_id):
+    archive = db.session.get(PollArchive, poll_id)
+    if not archive or archive.restored:
+        return False
+
+    path = archive_path(archive.file_name)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"archive file {path} of poll {poll_id} is missing")
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        columns = json.load(f)['columns']
+
+    db.session.add_all(Vote(poll_id=poll_id, option_id=option_id, user_id=user_id)
+                       for option_id, user_id in zip(columns['option_id'], columns['user_id']))
+    ArchivedVoteCount.query.filter_by(poll_id=poll_id).delete(synchronize_session=False)
+    ArchivedVoter.query.filter_by(poll_id=poll_id).delete(synchronize_session=False)
+    archive.restored = True
+    db.session.commit()
+    db.session.expire_all()
+
+    os.remove(path)
+    return True
+
+
+if __name__ == '__main__':
+    with create_app({'OUTBOX_WORKERS_ENABLED': False}).app_context():
+        db.create_all()
+        if len(sys.argv) == 3 and sys.argv[1] == 'restore':
+            try:
+                restored = restore_poll(int(sys.argv[2]))
+            except FileNotFoundError as e:
+                sys.exit(f"Can't restore poll {sys.argv[2]}: {e}")
+            print(f"Restored poll {sys.argv[2]}" if restored else f"Poll {sys.argv[2]} is not archived")
+        elif len(sys.argv) == 3 and sys.argv[1] == 'archive':
+            poll = db.session.get(Poll, int(sys.argv[2]))
+            if not poll:
+                print(f"Poll {sys.argv[2]} not found")
+            else:
+                vote_count = archive_poll(poll)
+                if vote_count is None:
+                    print(f"Poll {poll.poll_id} is already archived")
+                else:
+                    print(f"Archived {vote_count} votes of poll {poll.poll_id}")
+        else:
+            for poll_id, vote_count in archive_closed_polls().items():
+                print(f"Archived {vote_count} votes of poll {poll_id}")
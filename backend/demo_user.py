@@ -1,5 +1,5 @@
 from datetime import datetime, timedelta
-from server import app, db, User, Poll, PollOption, Comment
+from server import create_app, db, User, Poll, PollOption, Comment, UserActivity
 
 def seed_demo_user():
     # Create a demo friend
@@ -18,6 +18,7 @@ def seed_demo_user():
     db.session.flush()  # get p1.poll_id
     db.session.add(PollOption(poll_id=p1.poll_id, option_text="Red"))
     db.session.add(PollOption(poll_id=p1.poll_id, option_text="Blue"))
+    db.session.add(UserActivity(user_id=friend.id, poll_id=p1.poll_id, kind='create'))
 
     # Second poll
     p2 = Poll(
@@ -29,6 +30,7 @@ def seed_demo_user():
     db.session.flush()
     db.session.add(PollOption(poll_id=p2.poll_id, option_text="Tea"))
     db.session.add(PollOption(poll_id=p2.poll_id, option_text="Coffee"))
+    db.session.add(UserActivity(user_id=friend.id, poll_id=p2.poll_id, kind='create'))
 
     db.session.commit()
     print(f"Created polls: {p1.poll_id}, {p2.poll_id}")
@@ -41,10 +43,11 @@ def seed_demo_user():
         parent_comment_id=None
     )
     db.session.add(comment)
+    db.session.add(UserActivity(user_id=friend.id, poll_id=p1.poll_id, kind='comment'))
     db.session.commit()
     print(f"Added comment.id = {comment.comment_id} to poll.id = {p1.poll_id}")
 
 
 if __name__ == "__main__":
-    with app.app_context():
+    with create_app({'OUTBOX_WORKERS_ENABLED': False}).app_context():
         seed_demo_user()
@@ -1,46 +1,34 @@
 import os
+import hashlib
+import threading
+import time
+import uuid
 
-import requests
+from collections import OrderedDict
 from datetime import timedelta, datetime, UTC
-from flask import Flask, request, jsonify
+from functools import wraps
+import click
+from flask import Flask, Blueprint, current_app, request, jsonify
+from flask.cli import with_appcontext
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import ForeignKey, UniqueConstraint, CheckConstraint
-from sqlalchemy.orm import Mapped, mapped_column, relationship, backref
+from sqlalchemy import ForeignKey, UniqueConstraint, CheckConstraint, Index, or_, select, update
+from sqlalchemy.orm import Mapped, mapped_column, relationship, backref, joinedload, selectinload
 from flask_login import (
     LoginManager, UserMixin, login_user,
     login_required, logout_user, current_user
 )
 from flask_cors import CORS
-from google.oauth2 import id_token
-from google.auth.transport import requests as grequests
 from dotenv import load_dotenv
 
-# We import the secret key and the client-ids
-load_dotenv()
-
-# App isn't tested completely on web so unsure if web works
-CLIENT_IDS = [
-    os.getenv("GOOGLE_CLIENT_ID_WEB"),
-    os.getenv("GOOGLE_CLIENT_ID_IOS"),
-    os.getenv("GOOGLE_CLIENT_ID_ANDROID"),
-]
-
-app = Flask(__name__)
-app.secret_key = os.getenv("SECRET_KEY")
-app.config['REMEMBER_COOKIE_DURATION'] = timedelta(days=30)
-
-# Initializing CORS allows flutter frontend to make HTTP requests to your flask backend
-CORS(app,
-     supports_credentials=True,
-     origins=["http://localhost:5173"])
-
-# Set up db, uses sqlite
-db_path = os.path.join(os.path.dirname(__file__), 'poll.db')
-app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{db_path}'
-db = SQLAlchemy(app)
+# The app itself is built in create_app at the bottom of this file, so importing this module
+# (tests, demo_user.py, archive.py) doesn't read the environment or touch the db.
+# db and login_manager are bound to the app there and all endpoints live on this blueprint
+db = SQLAlchemy()
 
 # Initializes Flask-Login to manage user sessions and authentication
-login_manager = LoginManager(app)
+login_manager = LoginManager()
+
+api = Blueprint('api', __name__)
 
 # ---------------------- Models ----------------------
 class User(db.Model, UserMixin):
@@ -60,7 +48,7 @@ class User(db.Model, UserMixin):
         "Follow", foreign_keys="[Follow.followed_id]", back_populates="followed", cascade="all, delete-orphan")
 
 # Returns the current user's info if logged in
-@app.get('/whoami')
+@api.get('/whoami')
 def whoami():
     if current_user.is_authenticated:
         return jsonify(
@@ -73,7 +61,7 @@ def whoami():
 
 # Slightly different from previous endpoint
 # This one checks a specific id and has no connection to current_user
-@app.route('/users/<int:user_id>', methods=['GET'])
+@api.route('/users/<int:user_id>', methods=['GET'])
 def get_user_info(user_id):
     user = db.session.get(User, user_id)
     if not user:
@@ -98,6 +86,14 @@ class Poll(db.Model):
     comments: Mapped[list["Comment"]] = relationship("Comment", back_populates="poll", cascade="all, delete-orphan")
     options: Mapped[list["PollOption"]] = relationship("PollOption", back_populates="poll", cascade="all, delete-orphan")
 
+    # Only set once the poll has closed and its votes have been archived
+    archive: Mapped["PollArchive"] = relationship("PollArchive", uselist=False, cascade="all, delete-orphan")
+    archived_voters: Mapped[list["ArchivedVoter"]] = relationship("ArchivedVoter", cascade="all, delete-orphan")
+
+    def has_vote_from(self, user_id):
+        return (any(vote.user_id == user_id for option in self.options for vote in option.votes)
+                or any(voter.user_id == user_id for voter in self.archived_voters))
+
 class PollOption(db.Model):
     __tablename__ = "poll_option"
     option_id: Mapped[int] = mapped_column(primary_key=True)
@@ -105,9 +101,16 @@ class PollOption(db.Model):
     option_text: Mapped[str] = mapped_column(nullable=False)
     votes: Mapped[list["Vote"]] = relationship(
         "Vote", back_populates="option", cascade="all, delete-orphan")
+    archived_count: Mapped["ArchivedVoteCount"] = relationship(
+        "ArchivedVoteCount", uselist=False, cascade="all, delete-orphan")
 
     poll = relationship("Poll", back_populates="options")
 
+    # Live votes plus the ones that have been moved to the archive
+    @property
+    def vote_count(self):
+        return len(self.votes) + (self.archived_count.votes if self.archived_count else 0)
+
 class Vote(db.Model):
     __tablename__ = "vote"
     vote_id: Mapped[int] = mapped_column(primary_key=True)
@@ -120,6 +123,29 @@ class Vote(db.Model):
     # This constraint just makes sure that you can't vote twice
     __table_args__ = (UniqueConstraint('poll_id', 'user_id', name='_poll_user_uc'),)
 
+# When a closed poll is archived its vote rows are written to a compressed file and deleted,
+# the three tables below keep what the endpoints still need to know about them
+class PollArchive(db.Model):
+    __tablename__ = "poll_archive"
+    poll_id: Mapped[int] = mapped_column(ForeignKey("poll.poll_id"), primary_key=True)
+    archived_at: Mapped[datetime] = mapped_column(default=lambda: datetime.now(UTC), nullable=False)
+    file_name: Mapped[str] = mapped_column(nullable=False)
+
+    # Set when the votes have been restored, the row stays so that archive.py doesn't archive the poll again
+    restored: Mapped[bool] = mapped_column(default=False, nullable=False)
+
+class ArchivedVoteCount(db.Model):
+    __tablename__ = "archived_vote_count"
+    option_id: Mapped[int] = mapped_column(ForeignKey("poll_option.option_id"), primary_key=True)
+    poll_id: Mapped[int] = mapped_column(ForeignKey("poll.poll_id"), nullable=False, index=True)
+    votes: Mapped[int] = mapped_column(nullable=False)
+
+# Only who voted, not on what, so has_voted keeps working
+class ArchivedVoter(db.Model):
+    __tablename__ = "archived_voter"
+    poll_id: Mapped[int] = mapped_column(ForeignKey("poll.poll_id"), primary_key=True)
+    user_id: Mapped[int] = mapped_column(ForeignKey("user.id"), primary_key=True)
+
 class Comment(db.Model):
     __tablename__ = "comment"
     comment_id: Mapped[int] = mapped_column(primary_key=True)
@@ -176,9 +202,65 @@ class Follow(db.Model):
         CheckConstraint("follower_id <> followed_id",name="ck_no_self_follow"),
     )
 
+# One row every time a user creates, votes on or comments on a poll so that
+# "which polls has this user touched" is a range scan on user_id instead of going through every poll
+class UserActivity(db.Model):
+    __tablename__ = "user_activity"
+    activity_id: Mapped[int] = mapped_column(primary_key=True)
+    user_id: Mapped[int] = mapped_column(ForeignKey("user.id"), nullable=False)
+    poll_id: Mapped[int] = mapped_column(ForeignKey("poll.poll_id"), nullable=False)
+    kind: Mapped[str] = mapped_column(nullable=False)   # 'create', 'vote' or 'comment'
+    created_at: Mapped[datetime] = mapped_column(default=lambda: datetime.now(UTC), nullable=False)
+
+    poll = relationship("Poll")
+
+    __table_args__ = (
+        Index("ix_user_activity_user_id_kind_poll_id", "user_id", "kind", "poll_id"),   # list_polls filters
+        Index("ix_user_activity_user_id_activity_id", "user_id", "activity_id"),        # activity feed
+    )
+
+# Side effects of a write (notifications for now) are stored here in the same commit as the write itself
+# and handled later by the outbox workers, so the request doesn't have to wait for them
+class OutboxEvent(db.Model):
+    __tablename__ = "outbox_event"
+    event_id: Mapped[int] = mapped_column(primary_key=True)
+    kind: Mapped[str] = mapped_column(nullable=False)   # 'follow', 'vote', 'comment' or 'like'
+    actor_id: Mapped[int] = mapped_column(ForeignKey("user.id"), nullable=False)
+    target_user_id: Mapped[int] = mapped_column(ForeignKey("user.id"), nullable=True)
+    poll_id: Mapped[int] = mapped_column(ForeignKey("poll.poll_id"), nullable=True)
+    comment_id: Mapped[int] = mapped_column(ForeignKey("comment.comment_id"), nullable=True)
+    created_at: Mapped[datetime] = mapped_column(default=lambda: datetime.now(UTC), nullable=False)
+    processed_at: Mapped[datetime] = mapped_column(nullable=True, index=True)
+
+    # A worker claims a batch before handling it, so workers in other processes skip those events
+    claimed_by: Mapped[str] = mapped_column(nullable=True)
+    claimed_at: Mapped[datetime] = mapped_column(nullable=True)
+
+class Notification(db.Model):
+    __tablename__ = "notification"
+    notification_id: Mapped[int] = mapped_column(primary_key=True)
+    user_id: Mapped[int] = mapped_column(ForeignKey("user.id"), nullable=False)  # The one receiving it
+    kind: Mapped[str] = mapped_column(nullable=False)
+    actor_id: Mapped[int] = mapped_column(ForeignKey("user.id"), nullable=False)
+    poll_id: Mapped[int] = mapped_column(nullable=True)
+    comment_id: Mapped[int] = mapped_column(nullable=True)
+    created_at: Mapped[datetime] = mapped_column(nullable=False)
+
+    actor = relationship("User", foreign_keys=[actor_id])
+
+    # The inbox is always read newest first for one user
+    __table_args__ = (
+        Index("ix_notification_user_id_notification_id", "user_id", "notification_id"),
+    )
+
 # ---------------------- Google login ----------------------
-@app.route('/login', methods=['POST'])
+@api.route('/login', methods=['POST'])
 def google_login():
+    # Imported here since they take a while to import and are only needed when someone logs in
+    import requests
+    from google.oauth2 import id_token
+    from google.auth.transport import requests as grequests
+
     id_token_str   = request.json.get('id_token')   # User info
     access_token   = request.json.get('access_token')   # Allows Google API access
 
@@ -188,7 +270,7 @@ def google_login():
             info = id_token.verify_oauth2_token(id_token_str, grequests.Request())
 
             # We only accept tokens intended for our app
-            if info['aud'] not in CLIENT_IDS:
+            if info['aud'] not in current_app.config['GOOGLE_CLIENT_IDS']:
                 raise ValueError
             email = info['email']
 
@@ -224,7 +306,7 @@ def google_login():
         return jsonify(error='Invalid token'), 400
 
 # Login manager logs out and loads user below
-@app.route('/logout')
+@api.route('/logout')
 @login_required
 def logout():
     logout_user()
@@ -235,9 +317,125 @@ def logout():
 def load_user(uid):
     return db.session.get(User, int(uid))
 
+# ---------------------- Idempotency ----------------------
+# Mobile clients retry writes on flaky networks. If they send an Idempotency-Key header
+# the first response is stored and retries get the same response back without touching the db
+class IdempotencyEntry:
+    def __init__(self, fingerprint, expires):
+        self.fingerprint = fingerprint  # Hash of the request body, a key can't be reused for another payload
+        self.expires = expires
+        self.done = threading.Event()   # Set when the first request has finished
+        self.response = None            # (body, status, mimetype) once stored
+
+
+class IdempotencyStore:
+    def __init__(self, ttl, max_keys):
+        self.ttl = ttl.total_seconds()
+        self.max_keys = max_keys
+        self._entries = OrderedDict()   # Oldest first, so we can evict from the front
+        self._lock = threading.Lock()
+
+    # Returns the entry for the key and True if the caller is the first request and should run the view
+    def claim(self, key, fingerprint):
+        now = time.monotonic()
+        with self._lock:
+            # Entries are kept in order of expiry (complete moves them to the end), so expired ones are at the front
+            while self._entries and next(iter(self._entries.values())).expires <= now:
+                self._entries.popitem(last=False)
+
+            entry = self._entries.get(key)
+            if entry:
+                return entry, False
+
+            entry = IdempotencyEntry(fingerprint, now + self.ttl)
+            self._entries[key] = entry
+            while len(self._entries) > self.max_keys:
+                # Requests still running are never evicted, a retry would otherwise run the view twice
+                oldest_done = next((k for k, e in self._entries.items() if e.done.is_set()), None)
+                if oldest_done is None:
+                    break
+                del self._entries[oldest_done]
+            return entry, True
+
+    def complete(self, key, entry, response):
+        with self._lock:
+            entry.response = response
+            entry.expires = time.monotonic() + self.ttl
+            if key in self._entries:
+                self._entries.move_to_end(key)
+        entry.done.set()
+
+    # The first request failed, forget the key so the next retry runs the view again
+    def abandon(self, key, entry):
+        with self._lock:
+            if self._entries.get(key) is entry:
+                del self._entries[key]
+        entry.done.set()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# Put this below @login_required since keys are scoped per user
+def idempotent(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        if not key:
+            return view(*args, **kwargs)
+        if len(key) > 255:
+            return jsonify({'message': 'invalid idempotency key'}), 400
+
+        scoped_key = (current_user.id, request.method, request.path, key)
+        idempotency_store = current_app.extensions['idempotency_store']
+        fingerprint = hashlib.sha256(request.get_data()).hexdigest()
+
+        while True:
+            entry, first = idempotency_store.claim(scoped_key, fingerprint)
+            if first:
+                break
+            if entry.fingerprint != fingerprint:
+                return jsonify({'message': 'idempotency key reused with a different request'}), 422
+
+            # A duplicate that arrives while the first request is running waits for its response
+            if not entry.done.wait(current_app.config['IDEMPOTENCY_WAIT_SECONDS']):
+                return jsonify({'message': 'request with this idempotency key is in progress'}), 409
+            if entry.response is not None:
+                body, status, mimetype = entry.response
+                replay = current_app.response_class(body, status=status, mimetype=mimetype)
+                replay.headers['Idempotent-Replayed'] = 'true'
+                return replay
+            # The first request failed and was abandoned, loop and try to run it ourselves
+
+        try:
+            response = current_app.make_response(view(*args, **kwargs))
+        except Exception:
+            idempotency_store.abandon(scoped_key, entry)
+            raise
+
+        # Server errors aren't stored so that the client can retry them
+        if response.status_code >= 500:
+            idempotency_store.abandon(scoped_key, entry)
+        else:
+            idempotency_store.complete(scoped_key, entry,
+                                       (response.get_data(), response.status_code, response.mimetype))
+        return response
+    return wrapper
+
 # ---------------------- Poll endpoints ----------------------
-@app.route('/polls', methods=['POST'])
+# Everything the poll json (vote counts, has voted) needs, loaded with one query per relationship
+# for all polls at once instead of one query per poll and option
+POLL_LIST_LOADING = (
+    joinedload(Poll.creator),
+    selectinload(Poll.options).selectinload(PollOption.votes),
+    selectinload(Poll.options).selectinload(PollOption.archived_count),
+    selectinload(Poll.archived_voters),
+)
+
+@api.route('/polls', methods=['POST'])
 @login_required
+@idempotent
 def create_poll():
     data = request.get_json()
     if not data or 'question' not in data or 'options' not in data:
@@ -253,11 +451,12 @@ def create_poll():
 
     for option_text in data['options']:
         db.session.add(PollOption(poll_id=new_poll.poll_id, option_text=option_text))
+    db.session.add(UserActivity(user_id=current_user.id, poll_id=new_poll.poll_id, kind='create'))
 
     db.session.commit()
     return jsonify({'poll_id': new_poll.poll_id}), 201
 
-@app.route('/polls', methods=['GET'])
+@api.route('/polls', methods=['GET'])
 @login_required
 def list_polls():   # This endpoint is a general endpoint for almost all types of poll-lists we would want
     filter_type = request.args.get('filter')
@@ -269,32 +468,31 @@ def list_polls():   # This endpoint is a general endpoint for almost all types o
     except ValueError:
         return jsonify({'message': 'invalid user_id'}), 400
 
-    all_polls = Poll.query.all()
+    # Polls where the user has activity of one of the given kinds, read from the user_activity index
+    def polls_with_activity(kinds):
+        poll_ids = (db.session.query(UserActivity.poll_id)
+                    .filter(UserActivity.user_id == target_user_id, UserActivity.kind.in_(kinds)))
+        return (Poll.query.options(*POLL_LIST_LOADING)
+                .filter(Poll.poll_id.in_(poll_ids))
+                .order_by(Poll.poll_id)
+                .all())
 
     def user_has_voted(poll):
-        for option in poll.options:
-            for vote in option.votes:
-                if vote.user_id == target_user_id:
-                    return True
-        return False
+        return poll.has_vote_from(target_user_id)
 
     # A function that is used below for sorting
     def total_votes(poll):
-        return sum(len(option.votes) for option in poll.options)
+        return sum(option.vote_count for option in poll.options)
 
     # Here are all the filters handled
-    if filter_type == 'unvoted':
-        all_polls = [poll for poll in all_polls if not user_has_voted(poll)]
-    elif filter_type == 'user':
-        all_polls = [poll for poll in all_polls if poll.creator_id == target_user_id]
+    if filter_type == 'user':
+        all_polls = polls_with_activity(['create'])
     elif filter_type == 'interacted':
-        interacted = []
-        for poll in all_polls:
-            voted = any(vote.user_id == target_user_id for option in poll.options for vote in option.votes)
-            commented = any(comment.author_id == target_user_id for comment in poll.comments)
-            if voted or commented:
-                interacted.append(poll)
-        all_polls = interacted
+        all_polls = polls_with_activity(['vote', 'comment'])
+    else:
+        all_polls = Poll.query.options(*POLL_LIST_LOADING).all()
+        if filter_type == 'unvoted':
+            all_polls = [poll for poll in all_polls if not user_has_voted(poll)]
 
     # Here are all the sorting options handled
     # These aren't used currently since we didn't have time to implement sorting
@@ -312,7 +510,7 @@ def list_polls():   # This endpoint is a general endpoint for almost all types o
                 {
                     'option_id': option.option_id,
                     'option_text': option.option_text,
-                    'votes': len(option.votes)
+                    'votes': option.vote_count
                 } for option in poll.options
             ],
             'timeleft': poll.timeleft.isoformat(),
@@ -321,7 +519,7 @@ def list_polls():   # This endpoint is a general endpoint for almost all types o
 
     return jsonify(response_data), 200
 
-@app.route('/polls/<poll_id>', methods=['GET'])
+@api.route('/polls/<poll_id>', methods=['GET'])
 def retrieve_poll(poll_id):
     try:
         # Make sure poll_id is integer not string
@@ -329,14 +527,14 @@ def retrieve_poll(poll_id):
     except ValueError:
         return jsonify({'message': 'invalid poll id'}), 400
 
-    poll = db.session.get(Poll, poll_id)
+    poll = db.session.get(Poll, poll_id, options=POLL_LIST_LOADING)
     if not poll:
         return jsonify({'message': 'poll not found'}), 404
 
     # Creates a list of all the options to put in the final json
     options = [{'option_id': option.option_id,
                 'option_text': option.option_text,
-                'votes': len(option.votes)} for option in poll.options]
+                'votes': option.vote_count} for option in poll.options]
 
     return jsonify({
         'poll_id': poll.poll_id,
@@ -347,8 +545,9 @@ def retrieve_poll(poll_id):
     }), 200
 
 
-@app.route('/polls/<poll_id>/vote', methods=['POST'])
+@api.route('/polls/<poll_id>/vote', methods=['POST'])
 @login_required
+@idempotent
 def vote_poll(poll_id):
     data = request.get_json()
     if not data or 'option_id' not in data:
@@ -358,16 +557,23 @@ def vote_poll(poll_id):
     if not option:
         return jsonify({'message': 'option not found'}), 404
 
+    archive = option.poll.archive
+    if archive and not archive.restored:
+        return jsonify({'message': 'poll is closed'}), 400
+
     if Vote.query.filter_by(poll_id=poll_id, user_id=current_user.id).first():
         return jsonify({'message': 'already voted'}), 400
 
     vote = Vote(poll_id=poll_id, option_id=data['option_id'], user_id=current_user.id)
     db.session.add(vote)
+    db.session.add(UserActivity(user_id=current_user.id, poll_id=option.poll_id, kind='vote'))
+    db.session.add(OutboxEvent(kind='vote', actor_id=current_user.id, poll_id=option.poll_id))
     db.session.commit()
+    wake_outbox_workers()
     return jsonify({'message': 'vote recorded'}), 200
 
 # Checks if a user has voted on a certain poll
-@app.route('/polls/<poll_id>/has_voted', methods=['GET'])
+@api.route('/polls/<poll_id>/has_voted', methods=['GET'])
 @login_required
 def has_voted(poll_id):
     try:
@@ -375,13 +581,15 @@ def has_voted(poll_id):
     except ValueError:
         return jsonify({'message': 'invalid poll id'}), 400
 
-    voted = Vote.query.filter_by(poll_id=poll_id, user_id=current_user.id).first()
+    voted = (Vote.query.filter_by(poll_id=poll_id, user_id=current_user.id).first()
+             or db.session.get(ArchivedVoter, (poll_id, current_user.id)))
     return jsonify({'voted': voted is not None}), 200
 
 # ---------------------- Comment endpoints ----------------------
 
-@app.route('/polls/<int:poll_id>/comments', methods=['POST'])
+@api.route('/polls/<int:poll_id>/comments', methods=['POST'])
 @login_required
+@idempotent
 def comment_poll(poll_id):
     data = request.get_json() or {}
     text = data.get('comment_text')
@@ -395,12 +603,17 @@ def comment_poll(poll_id):
         parent_comment_id=None
     )
     db.session.add(comment)
+    db.session.flush()
+    db.session.add(UserActivity(user_id=current_user.id, poll_id=poll_id, kind='comment'))
+    db.session.add(OutboxEvent(kind='comment', actor_id=current_user.id, poll_id=poll_id,
+                               comment_id=comment.comment_id))
     db.session.commit()
+    wake_outbox_workers()
     return jsonify({'comment_id': comment.comment_id}), 201
 
 # Intended to be used, but we didn't have time
 # Practically the same as a normal comment but its parent is another comment instead of a poll
-@app.route('/comments/<int:parent_id>/replies', methods=['POST'])
+@api.route('/comments/<int:parent_id>/replies', methods=['POST'])
 @login_required
 def reply_comment(parent_id):
     data = request.get_json() or {}
@@ -419,7 +632,7 @@ def reply_comment(parent_id):
     return jsonify({'comment_id': comment.comment_id}), 201
 
 # Gets all the comments for a poll to display
-@app.route('/polls/<int:poll_id>/comments', methods=['GET'])
+@api.route('/polls/<int:poll_id>/comments', methods=['GET'])
 def retrieve_poll_comments(poll_id):
     poll = db.session.get(Poll, poll_id)
     if not poll:
@@ -446,7 +659,7 @@ def retrieve_poll_comments(poll_id):
 
 # ---------------------- Like Endpoints ----------------------
 
-@app.route('/comments/<int:comment_id>/like', methods=['POST'])
+@api.route('/comments/<int:comment_id>/like', methods=['POST'])
 @login_required
 def like_comment(comment_id):
     comment = db.session.get(Comment, comment_id)
@@ -458,11 +671,14 @@ def like_comment(comment_id):
 
     like = CommentLike(user_id=current_user.id, comment_id=comment_id)
     comment.likes.append(like)
+    db.session.add(OutboxEvent(kind='like', actor_id=current_user.id, target_user_id=comment.author_id,
+                               poll_id=comment.poll_id, comment_id=comment_id))
     db.session.commit()
+    wake_outbox_workers()
     return jsonify({'like_count': len(comment.likes)}), 200
 
 
-@app.route('/comments/<int:comment_id>/like', methods=['DELETE'])
+@api.route('/comments/<int:comment_id>/like', methods=['DELETE'])
 @login_required
 def unlike_comment(comment_id):
     comment = db.session.get(Comment, comment_id)
@@ -481,7 +697,7 @@ def unlike_comment(comment_id):
 
 # ---------------------- Follow endpoints ----------------------
 
-@app.route('/users/<int:uid>/follow', methods=['POST'])
+@api.route('/users/<int:uid>/follow', methods=['POST'])
 @login_required
 def follow_user(uid):
     if uid == current_user.id:
@@ -492,11 +708,13 @@ def follow_user(uid):
 
     follow = Follow(follower_id=current_user.id, followed_id=uid)
     current_user.following.append(follow)
+    db.session.add(OutboxEvent(kind='follow', actor_id=current_user.id, target_user_id=uid))
     db.session.commit()
+    wake_outbox_workers()
     return jsonify({'followed_id': uid}), 201
 
 
-@app.route('/users/<int:uid>/follow', methods=['DELETE'])
+@api.route('/users/<int:uid>/follow', methods=['DELETE'])
 @login_required
 def unfollow_user(uid):
     existing = next((follow for follow in current_user.following if follow.followed_id == uid), None)
@@ -508,7 +726,7 @@ def unfollow_user(uid):
     db.session.commit()
     return jsonify({'unfollowed_id': uid}), 200
 
-@app.route('/users/<int:user_id>/following_status', methods=['GET'])
+@api.route('/users/<int:user_id>/following_status', methods=['GET'])
 @login_required
 def check_following_status(user_id):
     if user_id == current_user.id:
@@ -517,24 +735,278 @@ def check_following_status(user_id):
     is_following = any(follow.followed_id == user_id for follow in current_user.following)
     return jsonify({'is_following': is_following}), 200
 
+# Newest first, paginated the same way as /notifications with ?before=<activity_id>&limit=<n>
+@api.route('/users/<int:user_id>/activity', methods=['GET'])
+@login_required
+def list_user_activity(user_id):
+    try:
+        limit = min(int(request.args.get('limit', 20)), 100)
+        before = request.args.get('before')
+        before = int(before) if before else None
+    except ValueError:
+        return jsonify({'message': 'invalid pagination'}), 400
+    if limit < 1:
+        return jsonify({'message': 'invalid pagination'}), 400
+
+    query = UserActivity.query.filter_by(user_id=user_id)
+    if before is not None:
+        query = query.filter(UserActivity.activity_id < before)
+    # The polls are joined in so the questions come with the same query
+    activity = (query.options(joinedload(UserActivity.poll))
+                .order_by(UserActivity.activity_id.desc())
+                .limit(limit)
+                .all())
+
+    return jsonify({
+        'activity': [{
+            'activity_id': item.activity_id,
+            'kind': item.kind,
+            'poll_id': item.poll_id,
+            'question': item.poll.question,
+            'created_at': item.created_at.isoformat(),
+        } for item in activity],
+        'next_before': activity[-1].activity_id if len(activity) == limit else None,
+    }), 200
+
 # Was to be implemented in frontend but no time
-@app.route('/users/me/following', methods=['GET'])
+@api.route('/users/me/following', methods=['GET'])
 @login_required
 def list_my_following():
     followed_ids = [follow.followed_id for follow in current_user.following]
     return jsonify(followed_ids), 200
 
+# ---------------------- Notifications ----------------------
+# Called by the write endpoints after commit so that idle workers don't have to wait for the next poll
+def wake_outbox_workers():
+    current_app.extensions['outbox_wakeup'].set()
+
+# Decides who gets notified about an event
+def notification_recipients(event):
+    if event.kind in ('follow', 'like'):
+        recipients = {event.target_user_id}
+    else:
+        poll = db.session.get(Poll, event.poll_id)
+        recipients = {poll.creator_id} if poll else set()
+        if event.kind == 'comment':
+            # Everyone else who has commented on the poll also gets to know
+            commenters = db.session.query(Comment.author_id).filter_by(poll_id=event.poll_id).distinct()
+            recipients.update(author_id for (author_id,) in commenters)
+
+    recipients.discard(event.actor_id)
+    recipients.discard(None)
+    return recipients
+
+# Handles one batch of unprocessed events and returns how many there were.
+# The batch is claimed with a single UPDATE first, so two workers (also in different processes,
+# e.g. the reloader or a multi-worker WSGI server) never handle the same event.
+# Claims older than OUTBOX_CLAIM_TIMEOUT are from a worker that died and can be taken over
+def drain_outbox(batch_size):
+    now = datetime.now(UTC)
+    claim = uuid.uuid4().hex
+    claimable = (select(OutboxEvent.event_id)
+                 .where(OutboxEvent.processed_at.is_(None),
+                        or_(OutboxEvent.claimed_by.is_(None),
+                            OutboxEvent.claimed_at < now - current_app.config['OUTBOX_CLAIM_TIMEOUT']))
+                 .order_by(OutboxEvent.event_id)
+                 .limit(batch_size))
+    db.session.execute(update(OutboxEvent)
+                       .where(OutboxEvent.event_id.in_(claimable))
+                       .values(claimed_by=claim, claimed_at=now)
+                       .execution_options(synchronize_session=False))
+    db.session.commit()
+
+    events = OutboxEvent.query.filter_by(claimed_by=claim).order_by(OutboxEvent.event_id).all()
+
+    # Handled events are only kept for a while so the table doesn't grow forever
+    (OutboxEvent.query
+     .filter(OutboxEvent.processed_at < now - current_app.config['OUTBOX_RETENTION'])
+     .delete(synchronize_session=False))
+
+    for event in events:
+        for user_id in notification_recipients(event):
+            db.session.add(Notification(user_id=user_id, kind=event.kind, actor_id=event.actor_id,
+                                        poll_id=event.poll_id, comment_id=event.comment_id,
+                                        created_at=event.created_at))
+        event.processed_at = now
+
+    db.session.commit()
+    return len(events)
+
+# Runs until app.extensions['outbox_stop'] is set
+def run_outbox_worker(app, worker):
+    outbox_wakeup = app.extensions['outbox_wakeup']
+    outbox_stop = app.extensions['outbox_stop']
+    with app.app_context():
+        while not outbox_stop.is_set():
+            outbox_wakeup.wait(app.config['OUTBOX_POLL_SECONDS'])
+            outbox_wakeup.clear()
+            try:
+                while not outbox_stop.is_set() and drain_outbox(app.config['OUTBOX_BATCH_SIZE']):
+                    pass
+            except Exception:
+                db.session.rollback()
+                app.logger.exception('outbox worker %d failed', worker)
+            finally:
+                db.session.remove()
+
+def start_outbox_workers(app):
+    for worker in range(app.config['OUTBOX_WORKERS']):
+        threading.Thread(target=run_outbox_worker, args=(app, worker),
+                         name=f'outbox-worker-{worker}', daemon=True).start()
+
+# Paginated with ?before=<notification_id>&limit=<n>, newest first
+@api.route('/notifications', methods=['GET'])
+@login_required
+def list_notifications():
+    try:
+        limit = min(int(request.args.get('limit', 20)), 100)
+        before = request.args.get('before')
+        before = int(before) if before else None
+    except ValueError:
+        return jsonify({'message': 'invalid pagination'}), 400
+    if limit < 1:
+        return jsonify({'message': 'invalid pagination'}), 400
+
+    query = Notification.query.filter_by(user_id=current_user.id)
+    if before is not None:
+        query = query.filter(Notification.notification_id < before)
+    notifications = query.order_by(Notification.notification_id.desc()).limit(limit).all()
+
+    return jsonify({
+        'notifications': [{
+            'notification_id': notification.notification_id,
+            'kind': notification.kind,
+            'actor_id': notification.actor_id,
+            'actor_username': notification.actor.username,
+            'poll_id': notification.poll_id,
+            'comment_id': notification.comment_id,
+            'created_at': notification.created_at.isoformat(),
+        } for notification in notifications],
+        # Pass this as before to get the next page, None when there are no more
+        'next_before': notifications[-1].notification_id if len(notifications) == limit else None,
+    }), 200
+
 # ---------------------- errors & debug ----------------------
-@app.errorhandler(405)
+@api.app_errorhandler(405)
 def not_allowed(e): return jsonify({'message': 'method not allowed'}), 405
-@app.errorhandler(404)
+@api.app_errorhandler(404)
 def not_found(e):   return jsonify({'message': 'not found'}), 404
-@app.errorhandler(400)
+@api.app_errorhandler(400)
 def bad_req(e):     return jsonify({'message': 'bad request'}), 400
-@app.errorhandler(500)
+@api.app_errorhandler(500)
 def server_err(e):  return jsonify({'message': 'internal server error'}), 500
 
+# Fills user_activity from the existing polls, votes and comments. Only does something on a db
+# that was created before the table existed, after that the endpoints keep it up to date
+def backfill_user_activity():
+    if UserActivity.query.first():
+        return
+
+    # The feed is ordered by activity_id, so the rows have to be inserted oldest first.
+    # Polls and votes have no timestamp: a poll is placed at timeleft minus the 12 hours create_poll gives it
+    # (timeleft is local time, post_time is UTC) and its votes right after it
+    polls = Poll.query.all()
+    created = {poll.poll_id: (poll.timeleft - timedelta(hours=12)).astimezone(UTC) for poll in polls}
+
+    rows = []   # (time, kind order, id, activity)
+    for poll in polls:
+        rows.append((created[poll.poll_id], 0, poll.poll_id,
+                     UserActivity(user_id=poll.creator_id, poll_id=poll.poll_id, kind='create')))
+    for vote in Vote.query.all():
+        rows.append((created[vote.poll_id], 1, vote.vote_id,
+                     UserActivity(user_id=vote.user_id, poll_id=vote.poll_id, kind='vote')))
+    for voter in ArchivedVoter.query.all():
+        rows.append((created[voter.poll_id], 1, voter.user_id,
+                     UserActivity(user_id=voter.user_id, poll_id=voter.poll_id, kind='vote')))
+    for comment in Comment.query.filter(Comment.poll_id.isnot(None)).all():
+        rows.append((comment.post_time.replace(tzinfo=UTC), 2, comment.comment_id,
+                     UserActivity(user_id=comment.author_id, poll_id=comment.poll_id, kind='comment')))
+
+    rows.sort(key=lambda row: row[:3])
+    for created_at, _, _, activity in rows:
+        activity.created_at = created_at
+        db.session.add(activity)
+    db.session.commit()
+
+# Creates missing tables and fills user_activity, safe to run on every start.
+# python server.py does this by itself, with flask run it is `flask --app server init-db` first
+def init_db():
+    db.create_all()
+    backfill_user_activity()
+
+@click.command('init-db')
+@with_appcontext
+def init_db_command():
+    init_db()
+    click.echo('Database is up to date')
+
+# ---------------------- App factory ----------------------
+# Builds a new app, config overrides the defaults below (tests use this for an in-memory db).
+# `flask --app server run` finds this function by itself (run `flask --app server init-db` before that)
+def create_app(config=None):
+    # We import the secret key and the client-ids
+    load_dotenv()
+
+    app = Flask(__name__)
+    app.secret_key = os.getenv("SECRET_KEY")
+    app.config['REMEMBER_COOKIE_DURATION'] = timedelta(days=30)
+
+    # App isn't tested completely on web so unsure if web works
+    app.config['GOOGLE_CLIENT_IDS'] = [
+        os.getenv("GOOGLE_CLIENT_ID_WEB"),
+        os.getenv("GOOGLE_CLIENT_ID_IOS"),
+        os.getenv("GOOGLE_CLIENT_ID_ANDROID"),
+    ]
+
+    # Set up db, uses sqlite. The file isn't opened until the first query
+    db_path = os.path.join(os.path.dirname(__file__), 'poll.db')
+    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{db_path}'
+
+    # How long a response is kept for replay when a client retries with the same Idempotency-Key,
+    # how many keys we keep at most and how long a duplicate waits for the first request to finish
+    app.config['IDEMPOTENCY_TTL'] = timedelta(hours=24)
+    app.config['IDEMPOTENCY_MAX_KEYS'] = 10000
+    app.config['IDEMPOTENCY_WAIT_SECONDS'] = 10
+
+    # Background workers that turn outbox events into notifications, handled events are deleted after OUTBOX_RETENTION
+    app.config['OUTBOX_WORKERS'] = 2
+    app.config['OUTBOX_BATCH_SIZE'] = 100
+    app.config['OUTBOX_POLL_SECONDS'] = 2
+    app.config['OUTBOX_RETENTION'] = timedelta(days=7)
+    app.config['OUTBOX_CLAIM_TIMEOUT'] = timedelta(minutes=5)
+
+    # Raw votes of closed polls are moved here by archive.py
+    app.config['ARCHIVE_DIR'] = os.path.join(os.path.dirname(__file__), 'archive')
+
+    if config:
+        app.config.update(config)
+
+    # Workers start with the app no matter how it is run (python server.py or flask run).
+    # Tests drain the outbox themselves and the scripts turn this off
+    app.config.setdefault('OUTBOX_WORKERS_ENABLED', not app.config['TESTING'])
+
+    # Initializing CORS allows flutter frontend to make HTTP requests to your flask backend
+    CORS(app,
+         supports_credentials=True,
+         origins=["http://localhost:5173"])
+
+    db.init_app(app)
+    login_manager.init_app(app)
+    app.register_blueprint(api)
+    app.cli.add_command(init_db_command)
+
+    # Per app so that every app (and test) gets its own
+    app.extensions['idempotency_store'] = IdempotencyStore(app.config['IDEMPOTENCY_TTL'],
+                                                           app.config['IDEMPOTENCY_MAX_KEYS'])
+    app.extensions['outbox_wakeup'] = threading.Event()
+    app.extensions['outbox_stop'] = threading.Event()
+
+    if app.config['OUTBOX_WORKERS_ENABLED']:
+        start_outbox_workers(app)
+    return app
+
 if __name__ == '__main__':
+    app = create_app()
     with app.app_context():
-        db.create_all()
+        init_db()
     app.run(host="0.0.0.0", port=5080)
@@ -0,0 +1,44 @@
+import statistics
+import subprocess
+import sys
+import time
+
+from server import create_app, db
+
+# Measures how long the backend takes to start, which is what worker spawns, the test suite and
+# the scripts (demo_user.py, archive.py) pay every time.
+# Usage: python startup_benchmark.py [runs]
+
+TEST_CONFIG = {"TESTING": True, "SQLALCHEMY_DATABASE_URI": "sqlite:///:memory:", "SECRET_KEY": "bench"}
+CREATE_APP = "import server; server.create_app({'OUTBOX_WORKERS_ENABLED': False})"
+
+# Starts a fresh interpreter per run since imports are only slow the first time in a process
+def time_subprocess(code, runs):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", code], check=True)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+# What each test pays for its own app with a fresh in-memory db
+def time_test_app(runs):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        app = create_app(TEST_CONFIG)
+        with app.app_context():
+            db.create_all()
+            db.drop_all()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+if __name__ == "__main__":
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+
+    print(f"python startup (baseline):     {time_subprocess('pass', runs) * 1000:7.1f} ms")
+    print(f"import server:                 {time_subprocess('import server', runs) * 1000:7.1f} ms")
+    print(f"import server + create_app():  "
+          f"{time_subprocess(CREATE_APP, runs) * 1000:7.1f} ms")
+    print(f"create_app() + create_all():   {time_test_app(runs * 10) * 1000:7.1f} ms per test app")
@@ -1,14 +1,20 @@
+import time
+
 import pytest
-from server import app, db, Poll, PollOption, Vote, User, Comment, CommentLike, Follow
+from server import create_app, db, Poll, PollOption, Vote, User, Comment, CommentLike, Follow, IdempotencyStore, \
+    OutboxEvent, Notification, drain_outbox, UserActivity, backfill_user_activity
+from archive import archive_closed_polls, archive_poll, restore_poll
+from flask import g
+from sqlalchemy import event
 from flask.sessions import SecureCookieSessionInterface
 from datetime import datetime, timedelta, UTC
 
 # ---------------------- Fixtures ----------------------
 
-# Setup test app with in-memory DB for isolation between runs
+# Setup a new test app with in-memory DB for isolation between tests
 @pytest.fixture()
 def test_app():
-    app.config.update({
+    app = create_app({
         "TESTING": True,
         "SQLALCHEMY_DATABASE_URI": "sqlite:///:memory:",
         "SECRET_KEY": "test_secret",
@@ -167,3 +173,297 @@ def test_follow_and_unfollow(client, test_app, login_user_fixture):
 def test_self_follow_blocked(client, login_user_fixture):
     res = client.post(f"/users/{login_user_fixture.id}/follow")
     assert res.status_code == 400
+
+# Retrying poll creation with the same Idempotency-Key should not create a second poll
+def test_create_poll_idempotent_retry(client, test_app, login_user_fixture):
+    headers = {"Idempotency-Key": "create-1"}
+    body = {"question": "Retry?", "options": ["Yes", "No"]}
+    res = client.post("/polls", json=body, headers=headers)
+    assert res.status_code == 201
+    poll_id = res.get_json()["poll_id"]
+
+    res = client.post("/polls", json=body, headers=headers)
+    assert res.status_code == 201
+    assert res.get_json()["poll_id"] == poll_id
+    assert res.headers["Idempotent-Replayed"] == "true"
+    assert Poll.query.count() == 1
+
+    # Same key with another payload is rejected
+    res = client.post("/polls", json={"question": "Other", "options": ["A", "B"]}, headers=headers)
+    assert res.status_code == 422
+
+# A retried vote replays the first response instead of failing with already voted
+def test_vote_idempotent_retry(client, test_app, login_user_fixture):
+    res = client.post("/polls", json={"question": "Vote retry", "options": ["A", "B"]})
+    poll_id = res.get_json()["poll_id"]
+    option_id = db.session.get(Poll, poll_id).options[0].option_id
+
+    headers = {"Idempotency-Key": "vote-1"}
+    res = client.post(f"/polls/{poll_id}/vote", json={"option_id": option_id}, headers=headers)
+    assert res.status_code == 200
+    res = client.post(f"/polls/{poll_id}/vote", json={"option_id": option_id}, headers=headers)
+    assert res.status_code == 200
+    assert Vote.query.count() == 1
+
+# Duplicates that arrive while the first request runs wait for its response, old keys are evicted
+def test_idempotency_store_coalesce_and_evict():
+    store = IdempotencyStore(timedelta(hours=1), max_keys=2)
+    entry, first = store.claim("a", "fp")
+    assert first
+    duplicate, first = store.claim("a", "fp")
+    assert not first and duplicate is entry and not duplicate.done.is_set()
+
+    store.complete("a", entry, (b"{}", 201, "application/json"))
+    assert duplicate.done.is_set() and duplicate.response[1] == 201
+
+    store.claim("b", "fp")
+    store.claim("c", "fp")
+    _, first = store.claim("a", "fp")
+    assert first
+
+    # b and c are still running, so they stay even though the store is over its limit
+    _, first = store.claim("d", "fp")
+    assert first
+    for key in ("b", "c"):
+        _, first = store.claim(key, "fp")
+        assert not first
+
+# Expired keys are dropped so the same key runs the view again
+def test_idempotency_store_expiry():
+    store = IdempotencyStore(timedelta(seconds=0), max_keys=10)
+    entry, _ = store.claim("a", "fp")
+    store.complete("a", entry, (b"{}", 201, "application/json"))
+    _, first = store.claim("a", "fp")
+    assert first
+
+# Writes only add outbox events, notifications show up once the outbox has been drained
+def test_outbox_notifications(client, test_app, login_user_fixture):
+    other = User(username="creator@example.com")
+    db.session.add(other)
+    db.session.flush()
+    poll = Poll(question="Notify?", creator_id=other.id, timeleft=datetime.now(UTC) + timedelta(hours=1))
+    db.session.add(poll)
+    db.session.commit()
+    other_id = other.id
+
+    assert client.post(f"/users/{other_id}/follow").status_code == 201
+    assert client.post(f"/polls/{poll.poll_id}/comments", json={"comment_text": "Hi"}).status_code == 201
+    assert OutboxEvent.query.count() == 2
+    assert Notification.query.count() == 0
+
+    assert drain_outbox(batch_size=1) == 1
+    assert drain_outbox(batch_size=10) == 1
+    assert drain_outbox(batch_size=10) == 0
+
+    # Log in as the poll creator, the test shares app context (and the cached current_user) with the requests
+    with client.session_transaction() as sess:
+        sess["_user_id"] = str(other_id)
+    g.pop("_login_user", None)
+    res = client.get("/notifications?limit=1")
+    assert res.status_code == 200
+    page = res.get_json()
+    assert [n["kind"] for n in page["notifications"]] == ["comment"]
+    assert page["notifications"][0]["actor_username"] == "test@example.com"
+
+    res = client.get(f"/notifications?limit=1&before={page['next_before']}")
+    assert [n["kind"] for n in res.get_json()["notifications"]] == ["follow"]
+
+# Events handled longer ago than OUTBOX_RETENTION are deleted by the next drain
+def test_outbox_prunes_old_events(test_app, login_user_fixture):
+    old = datetime.now(UTC) - test_app.config["OUTBOX_RETENTION"] - timedelta(hours=1)
+    db.session.add(OutboxEvent(kind="follow", actor_id=login_user_fixture.id, processed_at=old))
+    db.session.add(OutboxEvent(kind="follow", actor_id=login_user_fixture.id, processed_at=datetime.now(UTC)))
+    db.session.commit()
+
+    drain_outbox(batch_size=10)
+    assert OutboxEvent.query.count() == 1
+
+# Workers start with the app unless it is a test app or they are turned off
+def test_outbox_workers_enabled_default():
+    memory_db = {"SQLALCHEMY_DATABASE_URI": "sqlite:///:memory:"}
+    assert not create_app({**memory_db, "TESTING": True}).config["OUTBOX_WORKERS_ENABLED"]
+    assert not create_app({**memory_db, "OUTBOX_WORKERS_ENABLED": False}).config["OUTBOX_WORKERS_ENABLED"]
+
+# Events claimed by another worker are skipped until the claim times out
+def test_outbox_claims(test_app, login_user_fixture):
+    other = User(username="claimed@example.com")
+    db.session.add(other)
+    db.session.flush()
+    event = OutboxEvent(kind="follow", actor_id=login_user_fixture.id, target_user_id=other.id,
+                        claimed_by="other-process", claimed_at=datetime.now(UTC))
+    db.session.add(event)
+    db.session.commit()
+
+    assert drain_outbox(batch_size=10) == 0
+
+    event.claimed_at = datetime.now(UTC) - test_app.config["OUTBOX_CLAIM_TIMEOUT"] - timedelta(minutes=1)
+    db.session.commit()
+    assert drain_outbox(batch_size=10) == 1
+    assert Notification.query.count() == 1
+
+# An app with workers turns a committed write into a notification without anyone draining by hand
+def test_outbox_workers_deliver_notifications(tmp_path):
+    app = create_app({
+        "SQLALCHEMY_DATABASE_URI": f"sqlite:///{tmp_path / 'workers.db'}",
+        "SECRET_KEY": "test_secret",
+        "OUTBOX_WORKERS_ENABLED": True,
+        "OUTBOX_POLL_SECONDS": 0.1,
+    })
+    try:
+        with app.app_context():
+            db.create_all()
+            follower, followed = User(username="follower@example.com"), User(username="followed@example.com")
+            db.session.add_all([follower, followed])
+            db.session.commit()
+            follower_id, followed_id = follower.id, followed.id
+
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess["_user_id"] = str(follower_id)
+        assert client.post(f"/users/{followed_id}/follow").status_code == 201
+
+        with app.app_context():
+            deadline = time.monotonic() + 5
+            while not Notification.query.filter_by(user_id=followed_id).count():
+                assert time.monotonic() < deadline, "no notification from the outbox workers"
+                time.sleep(0.05)
+                db.session.remove()
+    finally:
+        app.extensions["outbox_stop"].set()
+        app.extensions["outbox_wakeup"].set()
+
+# Archiving moves the votes of a closed poll to a file but keeps counts and has_voted, restore brings them back
+def test_archive_and_restore_closed_poll(client, test_app, login_user_fixture, tmp_path):
+    test_app.config["ARCHIVE_DIR"] = str(tmp_path)
+    poll = Poll(question="Closed?", creator_id=login_user_fixture.id, timeleft=datetime.now() - timedelta(hours=1))
+    db.session.add(poll)
+    db.session.flush()
+    option = PollOption(poll_id=poll.poll_id, option_text="Yes")
+    db.session.add(option)
+    db.session.flush()
+    db.session.add(Vote(poll_id=poll.poll_id, option_id=option.option_id, user_id=login_user_fixture.id))
+    db.session.commit()
+    poll_id, option_id = poll.poll_id, option.option_id
+
+    assert archive_closed_polls() == {poll_id: 1}
+    assert archive_closed_polls() == {}
+    assert Vote.query.count() == 0
+    assert len(list(tmp_path.glob(f"poll_{poll_id}_*.json.gz"))) == 1
+
+    # Archiving it again is refused and leaves the archive file alone
+    assert archive_poll(db.session.get(Poll, poll_id)) is None
+    assert len(list(tmp_path.glob(f"poll_{poll_id}_*.json.gz"))) == 1
+
+    assert client.get(f"/polls/{poll_id}").get_json()["options"][0]["votes"] == 1
+    assert client.get(f"/polls/{poll_id}/has_voted").get_json()["voted"] is True
+    assert client.post(f"/polls/{poll_id}/vote", json={"option_id": option_id}).status_code == 400
+
+    # A vote on another poll gets the id the archived vote had, restore must not reuse it
+    open_poll_id = client.post("/polls", json={"question": "Open", "options": ["A", "B"]}).get_json()["poll_id"]
+    open_option_id = db.session.get(Poll, open_poll_id).options[0].option_id
+    assert client.post(f"/polls/{open_poll_id}/vote", json={"option_id": open_option_id}).status_code == 200
+
+    assert restore_poll(poll_id)
+    assert not restore_poll(poll_id)
+    assert Vote.query.filter_by(poll_id=poll_id).count() == 1
+    assert client.get(f"/polls/{poll_id}").get_json()["options"][0]["votes"] == 1
+    assert client.get(f"/polls/{poll_id}/has_voted").get_json()["voted"] is True
+    assert not list(tmp_path.glob(f"poll_{poll_id}_*.json.gz"))
+
+    # Restored polls are skipped by the archive job but can be archived again explicitly
+    assert archive_closed_polls() == {}
+    assert archive_poll(db.session.get(Poll, poll_id)) == 1
+    assert Vote.query.filter_by(poll_id=poll_id).count() == 0
+    assert client.get(f"/polls/{poll_id}").get_json()["options"][0]["votes"] == 1
+
+    # Without its file the poll can't be restored and stays archived
+    for path in tmp_path.glob(f"poll_{poll_id}_*.json.gz"):
+        path.unlink()
+    with pytest.raises(FileNotFoundError):
+        restore_poll(poll_id)
+    assert client.get(f"/polls/{poll_id}").get_json()["options"][0]["votes"] == 1
+
+# Listing polls takes the same number of queries no matter how many polls and options there are
+def test_list_polls_query_count(client, test_app, login_user_fixture):
+    def count_queries():
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        event.listen(db.engine, "before_cursor_execute", listener)
+        db.session.expire_all()
+        assert client.get("/polls").status_code == 200
+        event.remove(db.engine, "before_cursor_execute", listener)
+        return len(statements)
+
+    client.post("/polls", json={"question": "One", "options": ["A", "B"]})
+    one_poll = count_queries()
+    for i in range(5):
+        client.post("/polls", json={"question": f"More {i}", "options": ["A", "B", "C"]})
+    assert count_queries() == one_poll
+
+# The user and interacted filters and the activity feed are served from user_activity
+def test_user_activity_filters_and_feed(client, test_app, login_user_fixture):
+    other = User(username="other@example.com")
+    db.session.add(other)
+    db.session.flush()
+    theirs = Poll(question="Theirs", creator_id=other.id, timeleft=datetime.now(UTC) + timedelta(hours=1))
+    db.session.add(theirs)
+    db.session.flush()
+    option = PollOption(poll_id=theirs.poll_id, option_text="A")
+    db.session.add(option)
+    db.session.commit()
+    theirs_id, option_id = theirs.poll_id, option.option_id
+
+    mine_id = client.post("/polls", json={"question": "Mine", "options": ["A", "B"]}).get_json()["poll_id"]
+    client.post(f"/polls/{theirs_id}/vote", json={"option_id": option_id})
+    client.post(f"/polls/{theirs_id}/comments", json={"comment_text": "Hey"})
+
+    res = client.get("/polls?filter=user")
+    assert [poll["poll_id"] for poll in res.get_json()] == [mine_id]
+    res = client.get("/polls?filter=interacted")
+    assert [poll["poll_id"] for poll in res.get_json()] == [theirs_id]
+
+    res = client.get(f"/users/{login_user_fixture.id}/activity?limit=2")
+    page = res.get_json()
+    assert [item["kind"] for item in page["activity"]] == ["comment", "vote"]
+    res = client.get(f"/users/{login_user_fixture.id}/activity?limit=2&before={page['next_before']}")
+    assert [item["kind"] for item in res.get_json()["activity"]] == ["create"]
+
+# flask init-db creates the new tables and backfills user_activity on a db from before them
+def test_init_db_command(tmp_path):
+    app = create_app({"SQLALCHEMY_DATABASE_URI": f"sqlite:///{tmp_path / 'old.db'}", "OUTBOX_WORKERS_ENABLED": False})
+    with app.app_context():
+        db.create_all()
+        user = User(username="old@example.com")
+        db.session.add(user)
+        db.session.flush()
+        db.session.add(Poll(question="Old", creator_id=user.id, timeleft=datetime.now() + timedelta(hours=1)))
+        db.session.commit()
+        UserActivity.__table__.drop(db.engine)
+
+    result = app.test_cli_runner().invoke(args=["init-db"])
+    assert result.exit_code == 0, result.output
+    with app.app_context():
+        assert [activity.kind for activity in UserActivity.query.all()] == ["create"]
+
+# Existing data without activity rows gets backfilled once, oldest first so the feed stays in order
+def test_backfill_user_activity(client, test_app, login_user_fixture):
+    uid = login_user_fixture.id
+    first = Poll(question="Old", creator_id=uid, timeleft=datetime.now() - timedelta(hours=6))
+    second = Poll(question="Newer", creator_id=uid, timeleft=datetime.now() + timedelta(hours=11))
+    db.session.add_all([first, second])
+    db.session.flush()
+    option = PollOption(poll_id=first.poll_id, option_text="A")
+    db.session.add(option)
+    db.session.flush()
+    db.session.add(Vote(poll_id=first.poll_id, option_id=option.option_id, user_id=uid))
+    # Posted on the first poll before the second poll was created
+    db.session.add(Comment(comment_text="Old comment", author_id=uid, poll_id=first.poll_id,
+                           post_time=datetime.now(UTC) - timedelta(hours=12)))
+    db.session.commit()
+    second_id = second.poll_id
+
+    backfill_user_activity()
+    backfill_user_activity()
+    feed = client.get(f"/users/{uid}/activity").get_json()["activity"]
+    assert [(item["kind"], item["poll_id"] == second_id) for item in feed] == [
+        ("create", True), ("comment", False), ("vote", False), ("create", False)]